@@ -1,5 +1,7 @@
 import os
+import re
 from datetime import datetime
+from functools import lru_cache
 
 import geocoder
 import pytz
@@ -7,114 +9,231 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
 from dotenv import load_dotenv
-from skyfield.api import load, wgs84, Star
+from sgp4.api import SatrecArray, jday
+from skyfield.api import load, wgs84
+from skyfield.constants import AU_KM
 from skyfield.data import hipparcos, stellarium
-from skyfield.projections import build_stereographic_projection
+from skyfield.framelib import itrs
+from skyfield.positionlib import ICRF
+from skyfield.sgp4lib import TEME
+from skyfield.units import Angle
 from timezonefinder import TimezoneFinder
 
 # Load .env file
 load_dotenv()
 BING_MAPS_KEY = os.getenv("BING_MAPS_KEY")
 
+# Converts a magnitude into the natural log of its relative flux, so 10 ** (m / -2.5) == exp(m * MAGNITUDE_TO_LN_FLUX)
+MAGNITUDE_TO_LN_FLUX = -np.log(10) / 2.5
 
-# Gets the longitude and latitude of the user by geocoding their address using the Bing Maps API
-def get_longitude_latitude():
-    address = input("\nPlease enter your address (so we can find your longitude and latitude): ")
+# Lazily loaded Skyfield data, shared across menu invocations
+_TS = None
+_STARS = None
+_CONSTS = None
+
+# Satellites parsed from the Celestrak TLE file, and the same satellites keyed by name
+_SATELLITES = None
+_SATELLITES_BY_NAME = None
+
+# The star map figure and axes, reused between maps
+_FIG, _AX = None, None
+
+# Lazily built timezone lookup, which loads its polygon data when created
+_TZF = None
+
+# The most recently geocoded location, offered for reuse on later menu choices
+_LOCATION = None
+
+
+# Geocodes an address using the Bing Maps API, remembering recent addresses so they are only looked up once
+@lru_cache(maxsize=32)
+def _geocode(address):
     g = geocoder.bing(address, key='Ai7RzM03xcjVLqx48S1JnCyXWz9BVMkVYb79d-TPCMgEG3C-ZFBz4KXozNZ5gKDI')
     results = g.json
     return results['lat'], results['lng']
 
 
-# Gets the date and time of the user
-def get_utc_dt(latitude, longitude):
+# Gets the longitude and latitude of the user by geocoding their address,
+# offering to reuse the previous location if one has already been entered
+def get_longitude_latitude():
+    global _LOCATION
+    if _LOCATION is not None:
+        reuse = None
+        while reuse != 'Y' and reuse != 'N':
+            reuse = input("\nDo you wish to reuse your previous address? Y/N: ")
+        if reuse == 'Y':
+            return _LOCATION
+    address = input("\nPlease enter your address (so we can find your longitude and latitude): ")
+    _LOCATION = _geocode(address)
+    return _LOCATION
+
+
+# Returns the shared TimezoneFinder, building it on first use
+def _get_timezone_finder():
+    global _TZF
+    if _TZF is None:
+        _TZF = TimezoneFinder()
+    return _TZF
+
+
+# Asks the user for a date and time, returned as a naive local datetime
+def _prompt_local_dt():
     date = input("\nPlease enter the date you'd like to see in the format DD-MM-YYYY: ")
     time = input("\nPlease enter the time you'd like to see in the format HH:MM: ")
     date_and_time = date + " " + time
-    formatted_date = datetime.strptime(date_and_time, '%d-%m-%Y %H:%M')
-    timezonefinder = TimezoneFinder()
-    timezone_str = timezonefinder.timezone_at(lng=longitude, lat=latitude)
+    return datetime.strptime(date_and_time, '%d-%m-%Y %H:%M')
+
+
+# Converts a naive local datetime at the given latitude and longitude to UTC
+def _compute_utc_dt(latitude, longitude, formatted_date):
+    timezone_str = _get_timezone_finder().timezone_at(lng=longitude, lat=latitude)
     local = pytz.timezone(timezone_str)
     local_dt = local.localize(formatted_date, is_dst=None).astimezone(pytz.utc)
     return local_dt.astimezone(pytz.utc)
 
 
-# Loads the necessary data for a sky map from hipparcos and stellarium
-def load_star_data():
-    eph = load('de421.bsp')
-    url = ('https://raw.githubusercontent.com/Stellarium/stellarium/master'
-           '/skycultures/modern_st/constellationship.fab')
-    with load.open(hipparcos.URL) as f:
-        stars = hipparcos.load_dataframe(f)
-    with load.open(url) as f:
-        constellations = stellarium.parse_constellations(f)
-    return eph, stars, constellations
-
-
-# Formats the data for the star map by projecting the star positions on the sky,
-# returns the constellation lines as edges and the stars as an array
-def format_star_data(eph, stars, constellations):
-    lat, long = get_longitude_latitude()
-    utc_dt = get_utc_dt(lat, long)
-
-    earth = eph['earth']
-
-    ts = load.timescale()
-    t = ts.from_datetime(utc_dt)
-
-    observer = wgs84.latlon(latitude_degrees=lat, longitude_degrees=long).at(t)
-    observer.from_altaz(alt_degrees=90, az_degrees=0)
-    ra, dec, distance = observer.radec()
-    center_object = Star(ra=ra, dec=dec)
+# Gets the date and time of the user
+def get_utc_dt(latitude, longitude):
+    return _compute_utc_dt(latitude, longitude, _prompt_local_dt())
 
-    center = earth.at(t).observe(center_object)
-    projection = build_stereographic_projection(center)
 
-    star_positions = earth.at(t).observe(Star.from_dataframe(stars))
-    stars['x'], stars['y'] = projection(star_positions)
+# Returns the shared timescale, building it on first use
+def _get_ts():
+    global _TS
+    if _TS is None:
+        _TS = load.timescale(builtin=True)
+    return _TS
 
-    edges = [edge for name, edges in constellations for edge in edges]
-    edges_star1 = [star1 for star1, star2 in edges]
-    edges_star2 = [star2 for star1, star2 in edges]
 
-    return stars, edges_star1, edges_star2
+# Loads the necessary data for a sky map from hipparcos and stellarium,
+# only reading the files the first time it is called.
+# The stars are returned as a dictionary of arrays (ra and dec in degrees, mag, and xyz, the 3xN
+# unit vectors towards each star) plus hip2i, which maps a Hipparcos number to the star's position
+# in those arrays (-1 if absent). The constellation lines are returned as an (N, 2) int32 array
+# of the Hipparcos numbers at either end of each line
+def load_star_data():
+    global _STARS, _CONSTS
+    if _STARS is None:
+        with load.open(hipparcos.URL) as f:
+            stars = hipparcos.load_dataframe(f)
+        hip = stars.index.to_numpy()
+        hip2i = np.full(hip.max() + 1, -1, dtype=np.int32)
+        hip2i[hip] = np.arange(len(hip))
+        ra = stars['ra_degrees'].to_numpy()
+        dec = stars['dec_degrees'].to_numpy()
+        _STARS = {'ra': ra,
+                  'dec': dec,
+                  'mag': stars['magnitude'].to_numpy(),
+                  'xyz': radec_to_unit_vectors(np.deg2rad(ra), np.deg2rad(dec)),
+                  'hip2i': hip2i}
+    if _CONSTS is None:
+        url = ('https://raw.githubusercontent.com/Stellarium/stellarium/master'
+               '/skycultures/modern_st/constellationship.fab')
+        with load.open(url) as f:
+            constellations = stellarium.parse_constellations(f)
+        _CONSTS = np.fromiter((star for name, edges in constellations for edge in edges for star in edge),
+                              dtype=np.int32).reshape(-1, 2)
+    return _STARS, _CONSTS
+
+
+# Builds the rotation matrix that takes unit vectors into the frame of a stereographic projection
+# centred on the unit vector c, using the same basis as Skyfield's build_stereographic_projection
+def build_projection_matrix(c):
+    x_c, y_c, z_c = c
+    t0 = 1 / np.hypot(x_c, y_c)
+    return np.array([[t0 * y_c, -t0 * x_c, 0.0],
+                     [-t0 * z_c * x_c, -t0 * z_c * y_c, np.sqrt(1 - z_c ** 2)],
+                     c])
+
+
+# Converts right ascensions and declinations (radians) into a 3xN array of unit vectors
+def radec_to_unit_vectors(ra, dec):
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+
+
+# Projects the catalogue unit vectors onto the chart plane, treating the stars as fixed points at infinity.
+# The trigonometry is done once in load_star_data, so each map only costs one matrix multiply
+def project_stars(xyz, R):
+    v = R @ xyz
+    v[2] += 1
+    return v[0] / v[2], v[1] / v[2]
+
+
+# Projects the star positions on the sky as seen from latitude lat and longitude long at time t,
+# returns the projected star coordinates
+def _compute_star_data(stars, lat, long, t):
+    zenith = radec_to_unit_vectors(np.radians(long), np.radians(lat))
+    R = build_projection_matrix(itrs.rotation_at(t).T.dot(zenith))
+
+    x, y = project_stars(stars['xyz'], R)
+
+    return x, y
+
+
+# Formats the data for the star map by asking the user for their location and time
+# and projecting the star positions on the sky for them
+def format_star_data(stars):
+    lat, long = get_longitude_latitude()
+    utc_dt = get_utc_dt(lat, long)
+    t = _get_ts().from_datetime(utc_dt)
+    return _compute_star_data(stars, lat, long, t)
+
+
+# Gets a file name for a new star map image: StarMap.png if it is free, otherwise
+# Starmap<n>.png numbered one past the highest existing image, found with a single directory scan
+def get_image_path():
+    file_names = os.listdir('.')
+    if 'StarMap.png' not in file_names:
+        return 'StarMap.png'
+    existing = [int(match.group(1)) for match in map(re.compile(r'Starmap(\d+)\.png').fullmatch, file_names)
+                if match]
+    return 'Starmap' + repr(max(existing, default=0) + 1) + '.png'
+
+
+# Gets the figure and axes to draw a star map on, reusing the previous ones (cleared) while that figure
+# is still open. With a blocking GUI backend, closing the plt.show() window destroys the figure, so a new
+# one is made for every map; the figure is only reused when plt.show() does not block (e.g. Agg)
+def get_figure(chart_size):
+    global _FIG, _AX
+    if _FIG is None or not plt.fignum_exists(_FIG.number):
+        _FIG, _AX = plt.subplots(figsize=(chart_size, chart_size), facecolor='#041A40')
+    else:
+        _AX.clear()
+        _FIG.set_size_inches(chart_size, chart_size)
+    return _FIG, _AX
 
 
-# Draws the star map, using the stars and edges data from format_star_data
-def draw_map(chart_size, max_star_size, eph, stars, constellations, save_image):
-    stars, edges_star1, edges_star2 = format_star_data(eph, stars, constellations)
+# Draws the star map, using the star positions from format_star_data and the constellation edges
+def draw_map(chart_size, max_star_size, stars, constellations, save_image):
+    x, y = format_star_data(stars)
     limiting_magnitude = 10
-    bright_stars = (stars.magnitude <= limiting_magnitude)
-    magnitude = stars['magnitude'][bright_stars]
-    fig, ax = plt.subplots(figsize=(chart_size, chart_size), facecolor='#041A40')
+    magnitude = stars['mag']
+    star1 = stars['hip2i'][constellations[:, 0]]
+    star2 = stars['hip2i'][constellations[:, 1]]
+
+    bright_stars = magnitude <= limiting_magnitude
+    fig, ax = get_figure(chart_size)
 
-    marker_size = max_star_size * 10 ** (magnitude / -2.5)
-    ax.scatter(stars['x'][bright_stars], stars['y'][bright_stars],
+    marker_size = max_star_size * np.exp(magnitude[bright_stars] * MAGNITUDE_TO_LN_FLUX)
+    ax.scatter(x[bright_stars], y[bright_stars],
                s=marker_size, color='white', marker='.', linewidths=0,
                zorder=2)
 
-    xy1 = stars[['x', 'y']].loc[edges_star1].values
-    xy2 = stars[['x', 'y']].loc[edges_star2].values
-    lines_xy = np.rollaxis(np.array([xy1, xy2]), 1)
+    lines_xy = np.stack([np.column_stack([x[star1], y[star1]]),
+                         np.column_stack([x[star2], y[star2]])], axis=1)
 
     ax.add_collection(LineCollection(lines_xy, colors='#ffff', linewidths=0.15))
     ax.set_aspect('equal')
     ax.set_xlim(-1, 1)
     ax.set_ylim(-1, 1)
-    plt.axis('off')
+    ax.axis('off')
 
     if save_image == 'Y':
-        image_path = 'StarMap.png'
-        i = 0
-        while os.path.exists(image_path):
-            i += 1
-            image_name = 'Starmap'
-            image_name += repr(i)
-            image_path = image_name + ".png"
-        plt.savefig(image_path)
+        fig.savefig(get_image_path())
         plt.show()
     else:
         plt.show()
-    plt.close()
 
 
 # Generates a star map based on user input for chart size and maximum star size.
@@ -122,29 +241,41 @@ def draw_map(chart_size, max_star_size, eph, stars, constellations, save_image):
 def generate_star_map():
     chart_size = int(input('Enter chart size: '))
     max_star_size = int(input('Enter max star size: '))
-    eph, stars, constellations = load_star_data()
+    stars, constellations = load_star_data()
     save_to_file = None
     while save_to_file != 'Y' and save_to_file != 'N':
         save_to_file = input('Do you wish to save this image? Y/N: ')
-    draw_map(chart_size, max_star_size, eph, stars, constellations, save_to_file)
+    draw_map(chart_size, max_star_size, stars, constellations, save_to_file)
 
 
-# Gets a list of all satellites from the Celestrak API
+# Gets a list of all satellites from the Celestrak API, keeping the TLE file on disk
+# and only downloading it again once it is a day old
 def get_satellites():
-    stations_url = 'https://celestrak.com/NORAD/elements/stations.txt'
-    satellites = load.tle_file(stations_url)
-    print('Loaded', len(satellites), 'satellites')
-    return satellites
+    global _SATELLITES
+    if _SATELLITES is None:
+        stations_url = 'https://celestrak.com/NORAD/elements/stations.txt'
+        filename = 'stations.txt'
+        reload = not load.exists(filename) or load.days_old(filename) >= 1.0
+        _SATELLITES = load.tle_file(stations_url, filename=filename, reload=reload, ts=_get_ts())
+        print('Loaded', len(_SATELLITES), 'satellites')
+    return _SATELLITES
+
+
+# Gets a dictionary of all satellites keyed by name
+def get_satellites_by_name():
+    global _SATELLITES_BY_NAME
+    if _SATELLITES_BY_NAME is None:
+        _SATELLITES_BY_NAME = {sat.name: sat for sat in get_satellites()}
+    return _SATELLITES_BY_NAME
 
 
 # Gets a satellite by name, and returns it
 def get_satellite_by_name():
     not_chosen = True
     choice = None
-    satellites = get_satellites()
-    for sat in satellites:
+    for sat in get_satellites():
         print(sat.name)
-    by_name = {sat.name: sat for sat in satellites}
+    by_name = get_satellites_by_name()
     while not_chosen:
         choice = input("Please enter the name of the satellite you would like to track: ")
         if choice in by_name:
@@ -162,10 +293,9 @@ def get_all_viewable_satellites():
     return satellites
 
 
-# Gets the position of the bluffton observatory (i.e. your location)
-def get_bluffton():
-    longitude, latitude = get_longitude_latitude()
-    return wgs84.latlon(longitude, latitude, elevation_m=0)
+# Gets the position of an observatory at the given latitude and longitude
+def _compute_bluffton(latitude, longitude):
+    return wgs84.latlon(latitude, longitude, elevation_m=0)
 
 
 # Outputs the position of a satellite, formatted for readability
@@ -179,57 +309,103 @@ def output_position(position, name):
     print('Distance: {:.1f} km'.format(position[2].km))
 
 
-# Gets the topographic data for a specific satellite
-def get_topographic_data(difference):
-    ts = load.timescale()
-    t = ts.now()
+# Gets the topographic data for a specific satellite at time t
+def get_topographic_data(difference, t):
     return difference.at(t)
 
 
 # Gets the position of a specific satellite by altitude, azimuth and distance and returns these as a tuple (position)
-def get_position_data(satellite, bluffton):
+def get_position_data(satellite, bluffton, t):
     difference = satellite - bluffton
-    topo = get_topographic_data(difference)
+    topo = get_topographic_data(difference, t)
     alt, az, distance = topo.altaz()
     position = alt, az, distance
     return position
 
 
+# Gets the position of a satellite by altitude, azimuth and distance as seen from latitude and longitude at time t
+def _compute_position(satellite, latitude, longitude, t):
+    return get_position_data(satellite, _compute_bluffton(latitude, longitude), t)
+
+
 # Gets the position of a specific satellite by altitude, azimuth and distance and calls output function
 def track_satellite():
     satellite = get_satellite_by_name()
-    bluffton = get_bluffton()
-    position = get_position_data(satellite, bluffton)
+    latitude, longitude = get_longitude_latitude()
+    position = _compute_position(satellite, latitude, longitude, _get_ts().now())
     output_position(position, name=satellite.name)
 
 
-# Returns true if satellite is viewable - i.e. if altitude > 0 relative to Bluffton Observatory
-def is_viewable(position):
-    if position[0].degrees > 0:
-        return True
-    else:
-        return False
+# Propagates every satellite to time t in a single SGP4 call and returns their ITRF positions (km) as a 3xN array
+def get_itrf_positions(satellites, t):
+    sat_array = SatrecArray([sat.model for sat in satellites])
+    jd, fr = jday(*t.utc)
+    e, r, _ = sat_array.sgp4(np.array([jd]), np.array([fr]))
+    return itrs.rotation_at(t) @ TEME.rotation_at(t).T @ r[:, 0].T
+
+
+# Computes the altitude and azimuth (degrees) of the ITRF positions rx, ry, rz as seen by an observer at
+# ITRF position ox, oy, oz with geodetic latitude and longitude lat, lon (radians).
+# Works on plain float arrays only, so it can be fed straight from the batched SGP4 output.
+# Kept in NumPy: stations.txt only lists a few dozen satellites, too few to justify adding Numba as a dependency
+def _compute_altaz(rx, ry, rz, ox, oy, oz, lat, lon):
+    sin_lat, cos_lat = np.sin(lat), np.cos(lat)
+    sin_lon, cos_lon = np.sin(lon), np.cos(lon)
+    dx, dy, dz = rx - ox, ry - oy, rz - oz
+    horizontal = cos_lon * dx + sin_lon * dy
+    east = cos_lon * dy - sin_lon * dx
+    north = cos_lat * dz - sin_lat * horizontal
+    up = cos_lat * horizontal + sin_lat * dz
+    alt = np.degrees(np.arctan2(up, np.hypot(east, north)))
+    az = np.degrees(np.arctan2(east, north)) % 360.0
+    return alt, az
+
+
+# Gets the altitude and azimuth (degrees) of each ITRF position relative to the bluffton observatory
+def get_altaz(r_itrf, bluffton):
+    ox, oy, oz = bluffton.itrs_xyz.km
+    return _compute_altaz(r_itrf[0], r_itrf[1], r_itrf[2], ox, oy, oz,
+                          bluffton.latitude.radians, bluffton.longitude.radians)
+
+
+# Gets the altitude and azimuth (degrees) of every satellite as seen from latitude and longitude at time t
+def _compute_viewable_satellites(satellites, latitude, longitude, t):
+    bluffton = _compute_bluffton(latitude, longitude)
+    return get_altaz(get_itrf_positions(satellites, t), bluffton)
 
 
-# Prints all viewable satellites
+# Prints all viewable satellites (i.e. altitude > 0 relative to Bluffton Observatory), followed by the rest
 def list_viewable_satellites():
     all_satellites = get_all_viewable_satellites()
-    bluffton = get_bluffton()
-    for sat in all_satellites:
-        position = get_position_data(sat, bluffton)
-        if is_viewable(position):
-            print(sat.name, " is viewable (Altitude: {:.1f} \u00b0)".format(position[0].degrees))
-        else:
-            print(sat.name, " is not viewable (Altitude: {:.1f} \u00b0)".format(position[0].degrees))
+    latitude, longitude = get_longitude_latitude()
+    altitudes, _ = _compute_viewable_satellites(all_satellites, latitude, longitude, _get_ts().now())
+    viewable = altitudes > 0
+    for i in np.flatnonzero(viewable):
+        print(all_satellites[i].name, " is viewable (Altitude: {:.1f} \u00b0)".format(altitudes[i]))
+    for i in np.flatnonzero(~viewable):
+        print(all_satellites[i].name, " is not viewable (Altitude: {:.1f} \u00b0)".format(altitudes[i]))
+
+
+# Gets the right ascension (hours) and declination (degrees) of every satellite as seen from the bluffton
+# observatory at time t, propagating them in one batch and rotating all of the positions into the sky at once
+def _radec_batch(satellites, bluffton, t):
+    offset = get_itrf_positions(satellites, t) - bluffton.itrs_xyz.km[:, np.newaxis]
+    gcrs = itrs.rotation_at(t).T.dot(offset)
+    ra, dec, distance = ICRF(gcrs / AU_KM, t=t).radec()
+    return ra.hours, dec.degrees
+
+
+# Gets the right ascension and declination of a satellite as seen from latitude and longitude at time t
+def _compute_ra_dec(satellite, latitude, longitude, t):
+    ra, dec = _radec_batch([satellite], _compute_bluffton(latitude, longitude), t)
+    return Angle(hours=ra[0]), Angle(degrees=dec[0], signed=True)
 
 
 # Prints right ascension and declination of a specific satellite
 def get_ra_and_declination():
-    satellites = get_satellite_by_name()
-    bluffton = get_bluffton()
-    difference = satellites - bluffton
-    topo = get_topographic_data(difference)
-    ra, dec, distance = topo.radec()
+    satellite = get_satellite_by_name()
+    latitude, longitude = get_longitude_latitude()
+    ra, dec = _compute_ra_dec(satellite, latitude, longitude, _get_ts().now())
     print('\n The right ascension and declination are: ')
     print("Right Ascension: ", ra)
     print("Declination: ", dec)
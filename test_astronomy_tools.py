@@ -0,0 +1,134 @@
+import os
+
+import numpy as np
+import pytest
+from skyfield.api import EarthSatellite, Star, load, wgs84
+from skyfield.data import hipparcos
+from skyfield.projections import build_stereographic_projection
+
+import astronomy_tools
+
+# The star catalogue, constellations and ephemeris are read from the repository checkout
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A handful of different orbits, so the batched code is exercised with more than one or three satellites
+TLES = [
+    ('ISS (ZARYA)',
+     '1 25544U 98067A   24038.51041667  .00020000  00000+0  36000-3 0  9990',
+     '2 25544  51.6400 200.0000 0005000  90.0000 270.0000 15.50000000400000'),
+    ('CSS (TIANHE)',
+     '1 48274U 21035A   24038.50000000  .00020000  00000+0  25000-3 0  9990',
+     '2 48274  41.4700 100.0000 0005000 120.0000 240.0000 15.60000000150000'),
+    ('HST',
+     '1 20580U 90037B   24038.50000000  .00001000  00000+0  50000-4 0  9990',
+     '2 20580  28.4700  50.0000 0002500  60.0000 300.0000 15.14000000100000'),
+    ('NOAA 19',
+     '1 33591U 09005A   24038.40000000  .00000200  00000+0  13000-3 0  9990',
+     '2 33591  99.1900 120.0000 0013000 300.0000  60.0000 14.13000000770000'),
+    ('MOLNIYA 1-91',
+     '1 25485U 98054A   24038.30000000  .00000100  00000+0  10000-3 0  9990',
+     '2 25485  63.4000 250.0000 7200000 270.0000  20.0000  2.00600000186000'),
+]
+
+LOCATIONS = [(51.5, -0.1), (-33.9, 151.2), (32.2, -80.8)]
+
+
+@pytest.fixture
+def satellites():
+    ts = astronomy_tools._get_ts()
+    return [EarthSatellite(line1, line2, name, ts) for name, line1, line2 in TLES]
+
+
+@pytest.fixture
+def t():
+    return astronomy_tools._get_ts().utc(2024, 2, 8, 3, 17)
+
+
+# The batched altitudes and azimuths should match Skyfield's per-satellite altaz()
+@pytest.mark.parametrize('latitude, longitude', LOCATIONS)
+def test_compute_viewable_satellites_matches_skyfield(satellites, t, latitude, longitude):
+    altitudes, azimuths = astronomy_tools._compute_viewable_satellites(satellites, latitude, longitude, t)
+    bluffton = astronomy_tools._compute_bluffton(latitude, longitude)
+    for i, sat in enumerate(satellites):
+        alt, az, distance = (sat - bluffton).at(t).altaz()
+        assert altitudes[i] == pytest.approx(alt.degrees, abs=1e-9)
+        assert azimuths[i] == pytest.approx(az.degrees, abs=1e-9)
+
+
+# The batched right ascensions and declinations should match Skyfield's per-satellite radec()
+@pytest.mark.parametrize('latitude, longitude', LOCATIONS)
+def test_radec_batch_matches_skyfield(satellites, t, latitude, longitude):
+    bluffton = astronomy_tools._compute_bluffton(latitude, longitude)
+    ra_hours, dec_degrees = astronomy_tools._radec_batch(satellites, bluffton, t)
+    assert ra_hours.shape == dec_degrees.shape == (len(satellites),)
+    for i, sat in enumerate(satellites):
+        ra, dec, distance = (sat - bluffton).at(t).radec()
+        assert ra_hours[i] == pytest.approx(ra.hours, abs=1e-9)
+        assert dec_degrees[i] == pytest.approx(dec.degrees, abs=1e-9)
+
+
+# Satellites read from a fresh local TLE file should share the program's single timescale
+def test_get_satellites_uses_shared_timescale(tmp_path, monkeypatch):
+    lines = [line for tle in TLES for line in tle]
+    (tmp_path / 'stations.txt').write_text('\n'.join(lines) + '\n')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(astronomy_tools, '_SATELLITES', None)
+    satellites = astronomy_tools.get_satellites()
+    assert [sat.name for sat in satellites] == [name for name, line1, line2 in TLES]
+    assert all(sat.epoch.ts is astronomy_tools._get_ts() for sat in satellites)
+
+
+@pytest.fixture(scope='module')
+def star_data():
+    cwd = os.getcwd()
+    os.chdir(REPO_DIR)
+    try:
+        stars, constellations = astronomy_tools.load_star_data()
+        with load.open(hipparcos.URL) as f:
+            star_frame = hipparcos.load_dataframe(f)
+        earth = load('de421.bsp')['earth']
+    finally:
+        os.chdir(cwd)
+    return stars, constellations, star_frame, earth
+
+
+# Every constellation line should end on a star in the catalogue, as hip2i marks missing stars with -1
+def test_constellation_edges_are_in_catalogue(star_data):
+    stars, constellations, star_frame, earth = star_data
+    assert np.all(stars['hip2i'][constellations] >= 0)
+
+
+# The projected stars should match Skyfield's stereographic projection centred on the observer's zenith.
+# Proper motion is not applied, so the fastest moving stars may be a little further out
+@pytest.mark.parametrize('latitude, longitude, when', [
+    (51.5, -0.1, (2024, 2, 7, 22)),
+    (-33.9, 151.2, (2023, 7, 1, 3)),
+    (32.2, -80.8, (2020, 12, 21, 5, 30)),
+])
+def test_compute_star_data_matches_skyfield(star_data, latitude, longitude, when):
+    stars, constellations, star_frame, earth = star_data
+    t = astronomy_tools._get_ts().utc(*when)
+    x, y = astronomy_tools._compute_star_data(stars, latitude, longitude, t)
+
+    zenith = wgs84.latlon(latitude, longitude).at(t).from_altaz(alt_degrees=90, az_degrees=0)
+    ra, dec, distance = zenith.radec()
+    projection = build_stereographic_projection(earth.at(t).observe(Star(ra=ra, dec=dec)))
+    expected_x, expected_y = projection(earth.at(t).observe(Star.from_dataframe(star_frame)))
+
+    on_chart = (np.abs(expected_x) <= 1) & (np.abs(expected_y) <= 1)
+    error = np.hypot(x - expected_x, y - expected_y)[on_chart]
+    assert np.median(error) < 1e-5
+    assert np.max(error) < 2e-3
+
+
+# New star maps use StarMap.png first, then number one past the highest existing Starmap<n>.png
+@pytest.mark.parametrize('existing, expected', [
+    ([], 'StarMap.png'),
+    (['StarMap.png'], 'Starmap1.png'),
+    (['StarMap.png', 'Starmap2.png', 'Starmap10.png'], 'Starmap11.png'),
+])
+def test_get_image_path(tmp_path, monkeypatch, existing, expected):
+    for name in existing:
+        (tmp_path / name).touch()
+    monkeypatch.chdir(tmp_path)
+    assert astronomy_tools.get_image_path() == expected